@@ -4,6 +4,19 @@
  script.
  USAGE:
  python sort_folder.py --folder <INPUT-FOLDER> --labels <INPUT-LABEL1> <INPUT-LABEL2> ...
+ [--link {move,copy,hardlink,reflink}]
+ Requires Pillow >= 7.0.
+
+ PERFORMANCE:
+ Resizing each image for display is the main per-vote cost. Installing pillow-simd in place of Pillow gives
+ vectorised resampling without any code changes (it is a drop-in replacement importing as PIL):
+ pip uninstall pillow
+ CC="cc -mavx2" pip install --no-binary :all: pillow-simd==9.0.0.post1
+ JPEG decoding is the next biggest cost. Pillow should be linked against libjpeg-turbo (>= 2.0), e.g. by
+ installing it with "conda install -c conda-forge libjpeg-turbo" before building Pillow as above. A warning is
+ printed at start up when Pillow falls back to plain libjpeg.
+ If OpenCV is installed (pip install opencv-python) it is used to decode and resize images instead of Pillow.
+
  Author: Christian Baumgartner (c.baumgartner@imperial.ac.uk)
  Date: 31. Jan 2016
 
@@ -14,9 +27,184 @@
 
 import argparse
 import tkinter as tk
+import logging
+import logging.handlers
 import os
-from shutil import copyfile, move
-from PIL import ImageTk, Image, ImageOps
+import queue
+import sys
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfileobj, move
+from PIL import ImageTk, Image, ImageOps, features
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, reflinks fall back to regular copies there
+    fcntl = None
+
+try:
+    import cv2
+except ImportError:
+    # OpenCV is optional, images are loaded with Pillow without it
+    cv2 = None
+
+logger = logging.getLogger(__name__)
+
+# Size of the image view, images are scaled to fit and padded to this size
+TARGET_W, TARGET_H = 800, 600
+
+# File extensions of the images to sort
+IMAGE_EXTENSIONS = (".jpeg", ".tiff", ".jpg")
+
+# Number of upcoming images loaded in the background
+PREFETCH_DEPTH = 2
+
+# Ways of putting voted images into their label folder, mapped to the ImageGui method doing the transfer
+TRANSFER_MODES = {
+    'move': '_move_image',
+    'copy': '_copy_image',
+    'hardlink': '_link_image',
+    'reflink': '_reflink_image',
+}
+
+# Buffer size of the log output stream
+LOG_BUFSIZE = 64 * 1024
+
+# Number of log records collected before they are written out, warnings and errors are written at once
+LOG_FLUSH_EVERY = 32
+
+# ioctl request to clone a file on Linux copy-on-write filesystems, from linux/fs.h
+FICLONE = 0x40049409
+
+# Buffer size for copies that have to go through user space, shutil defaults to 64 KiB
+COPY_BUFSIZE = 1024 * 1024
+
+# Zero-copy functions in order of preference, only those available on this platform
+ZERO_COPY_FUNCS = []
+if hasattr(os, 'copy_file_range'):
+    # Linux >= 5.3, can reflink on copy-on-write filesystems such as btrfs or XFS
+    ZERO_COPY_FUNCS.append(lambda src_fd, dst_fd, offset, count: os.copy_file_range(src_fd, dst_fd, count,
+                                                                                    offset, offset))
+if hasattr(os, 'sendfile'):
+    ZERO_COPY_FUNCS.append(lambda src_fd, dst_fd, offset, count: os.sendfile(dst_fd, src_fd, offset, count))
+
+
+def _load_with_cv2(path, source_size, size):
+    """
+    Loads and resizes an image with OpenCV, which decodes and resamples in C without any Python in between
+    :param path: Path to image
+    :param source_size: Size of the image in the file as tuple (width, height)
+    :param size: Size to resize to as tuple (width, height)
+    :return: Resized PIL image, or None if OpenCV cannot read the file
+    """
+    # Decode JPEGs at 1/2, 1/4 or 1/8 scale when the image is at least that much larger than needed
+    scale = min(source_size[0] // size[0], source_size[1] // size[1])
+    flag = cv2.IMREAD_COLOR
+    for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                 (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if scale >= factor:
+            flag = reduced_flag
+            break
+
+    # Pillow does not apply EXIF orientation either, so both backends show the same image at the same size
+    image = cv2.imread(path, flag | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        return None
+
+    # INTER_AREA is both faster and smoother than the cubic filter for downscaling
+    interpolation = cv2.INTER_AREA if image.shape[1] > size[0] else cv2.INTER_LINEAR
+    image = cv2.resize(image, size, interpolation=interpolation)
+    return Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+
+
+class DeferredFlushStreamHandler(logging.StreamHandler):
+    """
+    Stream handler which writes records without flushing the stream after each one, it is only flushed when
+    flush() is called
+    """
+
+    def emit(self, record):
+        """
+        Writes a record to the stream
+        :param record: The log record
+        """
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchedLogHandler(logging.handlers.MemoryHandler):
+    """
+    Memory handler which flushes its target once per batch of records, so a batch of votes costs a single write
+    to the terminal. Records at flushLevel or above are written out at once.
+    """
+
+    def flush(self):
+        """
+        Hands all buffered records to the target and flushes the target
+        """
+        super().flush()
+        with self.lock:
+            if self.target is not None:
+                self.target.flush()
+
+
+def check_jpeg_backend():
+    """
+    Warn if Pillow was not built against libjpeg-turbo, which decodes JPEGs several times faster than libjpeg
+    :return: True if libjpeg-turbo is available
+    """
+    turbo = features.check_feature('libjpeg_turbo')
+    if not turbo:
+        warnings.warn("Pillow is not using libjpeg-turbo, JPEG decoding will be slower")
+
+    return bool(turbo)
+
+
+check_jpeg_backend()
+
+
+def load_display_image(path):
+    """
+    Loads and resizes an image from a given path using OpenCV if it is installed and can read the file,
+    otherwise using the Pillow library
+    :param path: Path to image
+    :return: Resized image, fitting inside TARGET_W x TARGET_H but not padded to it
+    """
+    # Opening only parses the header, the pixel data is decoded by resize
+    image = Image.open(path)
+    w, h = image.size
+
+    # Height is the limiting side if h / w > TARGET_H / TARGET_W, compared without dividing
+    if h * TARGET_W > w * TARGET_H:
+        width = w * TARGET_H // h
+        height = TARGET_H
+    else:
+        width = TARGET_W
+        height = h * TARGET_W // w
+
+    # OpenCV cannot read the size without decoding the whole image, so the header Pillow has already parsed
+    # is used to pick the reduced decode scale before cv2 reads the pixel data
+    if cv2 is not None:
+        resized = _load_with_cv2(path, (w, h), (width, height))
+        if resized is not None:
+            image.close()
+            return resized
+
+    # Let the JPEG decoder scale down by up to 1/8 while decoding, no-op for other formats
+    image.draft(image.mode, (width, height))
+
+    # Any remaining large downscale (e.g. TIFFs) is first reduced by an integer factor, so the filter only
+    # has to resample the last factor of at most 3. BILINEAR is plenty for a display preview, switch back to
+    # BICUBIC if aliasing becomes a problem for the annotators
+    image = image.resize((width, height), Image.BILINEAR, reducing_gap=3.0)
+    #image = image.resize(size, Image.ANTIALIAS)
+    #image = image.thumbnail(size, Image.ANTIALIAS)
+    return image
 
 
 class ImageGui:
@@ -25,15 +213,19 @@ class ImageGui:
     Useful, for sorting views into sub views or for removing outliers from the data.
     """
 
-    def __init__(self, master, labels, paths):
+    def __init__(self, master, labels, paths, link='move'):
         """
         Initialise GUI
         :param master: The parent window
         :param labels: A list of labels that are associated with the images
         :param paths: A list of file paths to images
+        :param link: How voted images are put into their label folder, one of TRANSFER_MODES
         :return:
         """
 
+        if link not in TRANSFER_MODES:
+            raise ValueError("link must be one of %s, not %r" % (", ".join(TRANSFER_MODES), link))
+
         # So we can quit the window from within the functions
         self.master = master
 
@@ -45,7 +237,10 @@ class ImageGui:
 
         # Start at the first file name
         self.index = 0
-        self.paths = paths
+        self.path = None
+        self.root = None
+        self.file_name = None
+        self.paths = iter(paths)
         self.labels = labels
 
         # Number of labels and paths
@@ -57,8 +252,30 @@ class ImageGui:
         self.image = None
         self.image_panel = tk.Label(frame)
 
+        # Display images are padded onto one preallocated canvas instead of a new image per frame. Only the
+        # main thread touches it, pasting into the PhotoImage copies the pixels so it can be reused straight away
+        self._canvas = Image.new('RGB', (TARGET_W, TARGET_H))
+
+        # The Tk image is created once and the canvas pasted into it for every new image, instead of creating
+        # and converting a new PhotoImage per frame
+        self.image = ImageTk.PhotoImage('RGB', self._canvas.size)
+        self.image_panel.configure(image=self.image)
+
+        # Upcoming images are decoded in the background while the current one is shown, the _upcoming window
+        # holds the next few paths taken from the paths list
+        self._executor = ThreadPoolExecutor(max_workers=PREFETCH_DEPTH)
+        self._prefetch = {}
+        self._upcoming = deque()
+
+        # Files are moved to their label folder by a background thread so voting never waits on the disk
+        self._transfer = getattr(self, TRANSFER_MODES[link])
+        self._transfer_q = queue.Queue()
+        threading.Thread(target=self._transfer_worker, daemon=True).start()
+        master.protocol("WM_DELETE_WINDOW", self.close)
+
         # set image container to first image
-        self.set_image(paths[self.index])
+        self.path, self.root, self.file_name = self._next_path()
+        self.set_image(self.path)
 
         # Make buttons
         self.buttons = []
@@ -82,73 +299,108 @@ class ImageGui:
         # Place the image in grid
         self.image_panel.grid(row=1, column=0, columnspan=self.n_labels+1, sticky='we')
 
-        # key bindings (so number pad can be used as shortcut)
-        for key in range(self.n_labels):
-            master.bind(str(key+1), self.vote_key)
+        # key bindings (so number pad can be used as shortcut), each key votes for its label directly
+        for key, label in enumerate(labels[:9]):
+            master.bind(str(key+1), lambda event, l=label: self.vote(l))
 
     def show_next_image(self):
         """
         Displays the next image in the paths list and updates the progress display
         """
         self.index += 1
+        self.path, self.root, self.file_name = self._next_path()
         progress_string = "%d/%d" % (self.index, self.n_paths)
         self.progress_label.configure(text=progress_string)
 
-        if self.index < self.n_paths:
-            self.set_image(self.paths[self.index])
+        if self.path is not None:
+            self.set_image(self.path)
         else:
-            self.master.quit()
+            self.close()
+
+    def _next_path(self):
+        """
+        Takes the next path out of the window of upcoming paths, topping the window up from the paths list
+        and starting to load each path that enters it in a background thread. Paths are split into folder and
+        file name as they enter the window, so voting does not have to.
+        :return: Tuple (path, folder, file name), all None once all paths have been shown
+        """
+        while len(self._upcoming) <= PREFETCH_DEPTH:
+            try:
+                path = next(self.paths)
+            except StopIteration:
+                break
+            self._upcoming.append((path,) + os.path.split(path))
+            if path not in self._prefetch:
+                self._prefetch[path] = self._executor.submit(load_display_image, path)
+
+        if not self._upcoming:
+            return None, None, None
+        return self._upcoming.popleft()
+
+    def close(self):
+        """
+        Waits for all pending file transfers to finish and closes the GUI
+        """
+        self._transfer_q.join()
+        for handler in logger.handlers:
+            handler.flush()
+        # Drop prefetches that have not started, otherwise exiting waits for them to decode
+        for future in self._prefetch.values():
+            future.cancel()
+        self._executor.shutdown(wait=False)
+        self.master.quit()
 
     def set_image(self, path):
         """
         Helper function which sets a new image in the image view
         :param path: path to that image
         """
-        image = self._load_image(path)
+        future = self._prefetch.pop(path, None)
+        if future is not None:
+            image = future.result()
+        else:
+            image = load_display_image(path)
+        image = self._pad_image(image)
         self.image_raw = image
-        self.image = ImageTk.PhotoImage(image)
-        self.image_panel.configure(image=self.image)
+        self.image.paste(image)
 
     def vote(self, label):
         """
-        Processes a vote for a label: Initiates the file copying and shows the next image
+        Processes a vote for a label: Queues the file transfer and shows the next image
         :param label: The label that the user voted for
         """
-        input_path = self.paths[self.index]
-        #self._copy_image(input_path, label)
-        self._move_image(input_path, label)
+        # Key presses can still arrive after the last image
+        if self.path is None:
+            return
+        self._transfer_q.put((self.path, self.root, self.file_name, label))
         self.show_next_image()
 
-    def vote_key(self, event):
+    def _transfer_worker(self):
         """
-        Processes voting via the number key bindings.
-        :param event: The event contains information about which key was pressed
+        Background thread which transfers voted images into their label folders in the order they were voted for
         """
-        pressed_key = int(event.char)
-        label = self.labels[pressed_key-1]
-        self.vote(label)
-
-    @staticmethod
-    def _load_image(path, size=(800, 600)):
+        while True:
+            input_path, root, file_name, label = self._transfer_q.get()
+            try:
+                logger.info(" %s --> %s", file_name, label)
+                output_path = os.path.join(root, label, file_name)
+                self._transfer(input_path, output_path)
+            except Exception:
+                # Keep the worker alive, otherwise later votes are lost and close() waits forever
+                logger.exception(" failed to transfer %s", input_path)
+            finally:
+                self._transfer_q.task_done()
+
+    def _pad_image(self, image):
         """
-        Loads and resizes an image from a given path using the Pillow library
-        :param path: Path to image
-        :param size: Size of display image
-        :return: Resized image
+        Centres a resized image on the black display canvas
+        :param image: PIL image no larger than the canvas
+        :return: The canvas
         """
-        image = Image.open(path)
-        ratio = min(size[1] / image.size[1], size[0] / image.size[0])
-        width = int(image.size[0] * ratio)
-        height = int(image.size[1] * ratio)
-        image = image.resize((width, height), Image.BICUBIC)
-
-        delta_w = size[0] - image.size[0]
-        delta_h = size[1] - image.size[1]
-        pad = (delta_w // 2, delta_h // 2, delta_w - (delta_w // 2), delta_h - (delta_h // 2))
-        image = ImageOps.expand(image, pad)
-        #image = image.resize(size, Image.ANTIALIAS)
-        #image = image.thumbnail(size, Image.ANTIALIAS)
-        return image
+        width, height = image.size
+        self._canvas.paste(0, (0, 0, TARGET_W, TARGET_H))
+        self._canvas.paste(image, ((TARGET_W - width) >> 1, (TARGET_H - height) >> 1))
+        return self._canvas
 
     @staticmethod
     def _expand_to_square(img, size):
@@ -166,31 +418,44 @@ class ImageGui:
         return out
 
     @staticmethod
-    def _copy_image(input_path, label):
+    def _copy_image(input_path, output_path):
         """
-        Copies a file to a new label folder using the shutil library. The file will be copied into a
+        Copies a file to a new label folder using fast_copyfile. The file will be copied into a
         subdirectory called label in the input folder.
         :param input_path: Path of the original image
-        :param label: The label
+        :param output_path: Path of the image in the label folder
         """
-        root, file_name = os.path.split(input_path)
-        output_path = os.path.join(root, label, file_name)
-        print(" %s --> %s" % (file_name, label))
-        copyfile(input_path, output_path)
+        fast_copyfile(input_path, output_path)
         #os.symlink(input_path, output_path)
 
     @staticmethod
-    def _move_image(input_path, label):
+    def _link_image(input_path, output_path):
+        """
+        Hard links a file into a new label folder, which takes constant time regardless of the file size. The
+        label folders are inside the input folder, so both paths are always on the same filesystem.
+        :param input_path: Path of the original image
+        :param output_path: Path of the image in the label folder
+        """
+        os.link(input_path, output_path)
+
+    @staticmethod
+    def _reflink_image(input_path, output_path):
+        """
+        Copies a file to a new label folder as a copy-on-write clone using reflink_file
+        :param input_path: Path of the original image
+        :param output_path: Path of the image in the label folder
+        """
+        reflink_file(input_path, output_path)
+
+    @staticmethod
+    def _move_image(input_path, output_path):
         """
         Moves a file to a new label folder using the shutil library. The file will be moved into a
-        subdirectory called label in the input folder. This is an alternative to _copy_image, which is not
-        yet used, function would need to be replaced above.
+        subdirectory called label in the input folder. This is the default, see TRANSFER_MODES for the
+        alternatives.
         :param input_path: Path of the original image
-        :param label: The label
+        :param output_path: Path of the image in the label folder
         """
-        root, file_name = os.path.split(input_path)
-        output_path = os.path.join(root, label, file_name)
-        print(" %s --> %s" % (file_name, label))
         move(input_path, output_path)
 
 
@@ -203,6 +468,90 @@ def make_folder(directory):
         os.makedirs(directory)
 
 
+def _copy_fds(copy_chunk, src_fd, dst_fd, size):
+    """
+    Copies size bytes between two open file descriptors with a kernel-side copy function
+    :param copy_chunk: Function (src_fd, dst_fd, offset, count) returning the number of bytes copied
+    :param src_fd: Source file descriptor
+    :param dst_fd: Destination file descriptor
+    :param size: Number of bytes to copy
+    :return: False if the copy function is not supported for these files, True once the copy is done
+    """
+    offset = 0
+    while offset < size:
+        try:
+            sent = copy_chunk(src_fd, dst_fd, offset, size - offset)
+        except OSError:
+            # Nothing written yet, so the caller can safely try the next method
+            if offset == 0:
+                return False
+            raise
+        if sent == 0:
+            # Some filesystems report no data instead of failing
+            if offset == 0:
+                return False
+            raise OSError("file truncated after %d of %d bytes" % (offset, size))
+        offset += sent
+    return True
+
+
+def fast_copyfile(src, dst):
+    """
+    Copies a file without passing the data through user space where possible. Tries copy_file_range, then
+    sendfile and finally falls back to a buffered copy with a COPY_BUFSIZE buffer.
+    :param src: Path of the source file
+    :param dst: Path of the destination file
+    """
+    if ZERO_COPY_FUNCS:
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            size = os.fstat(src_fd).st_size
+            # Virtual files such as those in /proc report a size of 0, they are copied by reading them below
+            if size > 0:
+                dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                try:
+                    for copy_chunk in ZERO_COPY_FUNCS:
+                        if _copy_fds(copy_chunk, src_fd, dst_fd, size):
+                            return
+                finally:
+                    os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+
+
+def scan_images(directory):
+    """
+    Lists the images in a folder. The whole folder is read before the GUI starts, because voted images are
+    moved out of it and directory iteration is unreliable while entries are being removed (images could be
+    skipped on e.g. APFS or SMB shares).
+    :param directory: The folder to search
+    :return: List of image file paths
+    """
+    with os.scandir(directory) as entries:
+        return [entry.path for entry in entries if entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file()]
+
+
+def reflink_file(src, dst):
+    """
+    Creates a copy-on-write clone of a file, which shares its data with the original until either is modified
+    (btrfs, XFS). Falls back to fast_copyfile where cloning is not supported.
+    :param src: Path of the source file
+    :param dst: Path of the destination file
+    """
+    if fcntl is not None:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+
+    fast_copyfile(src, dst)
+
+
 # The main bit of the script only gets exectured if it is directly called
 if __name__ == "__main__":
 
@@ -210,27 +559,36 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--folder', help='Input folder where the *tif images should be', required=True)
     parser.add_argument('-l', '--labels', nargs='+', help='Possible labels in the images', required=True)
+    parser.add_argument('--link', choices=TRANSFER_MODES, default='move',
+                        help='How voted images are put into their label folder, hardlink and reflink leave the '
+                             'original in place without copying its data')
     args = parser.parse_args()
 
     # grab input arguments from args structure
     input_folder = args.folder
     labels = args.labels
 
+    # Log votes to stdout through a buffered stream, which is flushed in batches and when the GUI closes
+    try:
+        log_stream = open(sys.stdout.fileno(), 'w', buffering=LOG_BUFSIZE, closefd=False)
+    except (AttributeError, OSError, ValueError):
+        # No stdout file descriptor, e.g. under pythonw on Windows
+        logger.addHandler(logging.StreamHandler())
+    else:
+        logger.addHandler(BatchedLogHandler(LOG_FLUSH_EVERY, flushLevel=logging.WARNING,
+                                            target=DeferredFlushStreamHandler(log_stream)))
+    logger.setLevel(logging.INFO)
+
     # Make folder for the new labels
     for label in labels:
         if not os.path.exists(os.path.join(input_folder, label)):
             make_folder(os.path.join(input_folder, label))
 
     # Put all image file paths into a list
-    paths = []
-    for file in os.listdir(input_folder):
-        if file.endswith(".jpeg") or file.endswith(".tiff") or file.endswith(".jpg"):
-
-            path = os.path.join(input_folder, file)
-            paths.append(path)
+    paths = scan_images(input_folder)
 
     # Start the GUI
     root = tk.Tk()
     #root.geometry("1000x1000")
-    app = ImageGui(root, labels, paths)
+    app = ImageGui(root, labels, paths, link=args.link)
     root.mainloop()
\ No newline at end of file